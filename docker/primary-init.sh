@@ -0,0 +1,9 @@
+#!/bin/bash
+# Runs once when the primary database is created: allows the replica to stream the WAL
+set -e
+
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
+	CREATE ROLE $REPLICATION_USER WITH REPLICATION LOGIN PASSWORD '$REPLICATION_PASSWORD';
+EOSQL
+
+echo "host replication $REPLICATION_USER all md5" >> "$PGDATA/pg_hba.conf"
@@ -0,0 +1,13 @@
+#!/bin/bash
+# Starts a hot standby of the primary, cloning it on first start
+set -e
+
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+    until pg_basebackup --host="$PRIMARY_HOST" --username="$REPLICATION_USER" --pgdata="$PGDATA" --wal-method=stream --write-recovery-conf; do
+        echo "Waiting for the primary to accept replication connections..."
+        sleep 2
+    done
+    chmod 0700 "$PGDATA"
+fi
+
+exec postgres -c hot_standby=on
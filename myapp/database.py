@@ -1,12 +1,145 @@
-from sqlalchemy import create_engine
-from sqlmodel import SQLModel
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from sqlalchemy import create_engine, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel, select
+from myapp.models import IngestionRun
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Primary database, all writes go there
+DATABASE_URL = os.environ.get("DATABASE_URL", "postgresql://admin:welovetheenvironment@db/ecoact_db")
+# Comma separated URLs of read replicas of the primary, reads use the primary when there are none
+DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# 'round_robin' cycles through the replicas, 'least_busy' picks the one with the fewest reads in progress,
+# then the lowest recent read time
+REPLICA_SELECTION = os.environ.get("REPLICA_SELECTION", "round_robin")
+# Seconds a replica is skipped after a failed connection
+REPLICA_RETRY_SECONDS = float(os.environ.get("REPLICA_RETRY_SECONDS", "30"))
+# Seconds to wait for a replica to accept a connection before failing over
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get("REPLICA_CONNECT_TIMEOUT", "2"))
 
-DATABASE_URL = "postgresql://admin:welovetheenvironment@db/ecoact_db"
 engine = create_engine(DATABASE_URL)
 
+def create_replica_engine(url: str):
+    """
+    Creates the engine of a read replica, checking its connections before use so a replica
+    that went down is detected when a session starts rather than in the middle of a query.
+    """
+    connect_args = {}
+    if make_url(url).get_backend_name() == 'postgresql':
+        connect_args['connect_timeout'] = REPLICA_CONNECT_TIMEOUT
+    return create_engine(url, pool_pre_ping=True, connect_args=connect_args)
+
+# Weight of the last read in the moving average of the read time of a replica
+LATENCY_SMOOTHING = 0.2
+# Replicas whose read time is within this factor of the fastest one are considered as fast
+LATENCY_TOLERANCE = 1.5
+# Seconds after which the read time of an unused replica is forgotten, so it gets tried again
+LATENCY_EXPIRY_SECONDS = 10.0
+
+# Replicas with the time until which they are skipped after a failure, their reads in
+# progress in this process and the moving average of their read time
+replicas = [
+    {'url': url, 'engine': create_replica_engine(url), 'retry_at': 0.0, 'in_flight': 0, 'latency': 0.0, 'used_at': 0.0}
+    for url in DATABASE_REPLICA_URLS
+]
+_round_robin = itertools.count()
+
 def create_db_and_tables() -> None:
     """
     Creates the database tables defined in SQLModel models.
     """
     SQLModel.metadata.create_all(engine)
 
+def replica_order() -> list:
+    """
+    Orders the healthy replicas in which they should be tried for the next read.
+    """
+    now = time.monotonic()
+    healthy = [replica for replica in replicas if replica['retry_at'] <= now]
+    if not healthy:
+        return []
+    if REPLICA_SELECTION == 'least_busy':
+        # The routes read synchronously, so reads in progress are mostly 0 and the read time decides
+        def load(replica):
+            latency = replica['latency'] if now - replica['used_at'] < LATENCY_EXPIRY_SECONDS else 0.0
+            return replica['in_flight'], latency
+
+        ranked = sorted(healthy, key=load)
+        in_flight, latency = load(ranked[0])
+        # Replicas about as fast as the fastest one share the reads in round robin order,
+        # rather than all of them going to whichever was measured faster last
+        fastest = [
+            replica for replica in healthy
+            if replica['in_flight'] == in_flight and load(replica)[1] <= latency * LATENCY_TOLERANCE + 0.001
+        ]
+        start = next(_round_robin) % len(fastest)
+        return fastest[start:] + fastest[:start] + [replica for replica in ranked if replica not in fastest]
+    start = next(_round_robin) % len(healthy)
+    return healthy[start:] + healthy[:start]
+
+def open_replica_session(min_version: int = None):
+    """
+    Opens a session on the first replica accepting connections, marking the others as unhealthy.
+
+    Args:
+        min_version (int): Skip the replicas that haven't replicated this ingestion run yet.
+
+    Returns:
+        session (Session): The session, with its connection open, None if no replica is available.
+        replica (dict): The replica of the session.
+    """
+    for replica in replica_order():
+        session = Session(replica['engine'])
+        try:
+            session.connection()
+            if min_version is not None and (session.exec(select(func.max(IngestionRun.id))).one() or 0) < min_version:
+                session.close()
+                logging.info(f"Replica {make_url(replica['url']).render_as_string(hide_password=True)} is behind version {min_version}, skipping it")
+                continue
+        except OperationalError as e:
+            session.close()
+            replica['retry_at'] = time.monotonic() + REPLICA_RETRY_SECONDS
+            logging.warning(f"Replica {make_url(replica['url']).render_as_string(hide_password=True)} is unavailable, skipping it for {REPLICA_RETRY_SECONDS}s: {e}")
+            continue
+        return session, replica
+    return None, None
+
+@contextmanager
+def read_session(primary: bool = False, min_version: int = None):
+    """
+    Opens a session for reads, on a replica if any is available, otherwise on the primary.
+
+    Args:
+        primary (bool): Read from the primary, for reads that must see writes that were just made.
+        min_version (int): Only use a replica that has replicated this ingestion run, for reads
+            that must be consistent with an earlier read from another replica.
+
+    Yields:
+        Session: The session.
+    """
+    session, replica = (None, None) if primary else open_replica_session(min_version)
+    if session is None:
+        with Session(engine) as session:
+            yield session
+        return
+
+    replica['in_flight'] += 1
+    start = time.monotonic()
+    try:
+        with session:
+            yield session
+    finally:
+        replica['in_flight'] -= 1
+        now = time.monotonic()
+        if now - replica['used_at'] < LATENCY_EXPIRY_SECONDS:
+            replica['latency'] += LATENCY_SMOOTHING * (now - start - replica['latency'])
+        else:
+            # No recent average to smooth with
+            replica['latency'] = now - start
+        replica['used_at'] = now
@@ -1,12 +1,29 @@
 from pydantic import ValidationError
-from sqlalchemy import and_
+from sqlalchemy import and_, delete, func, select as select_columns, text, update
 from sqlmodel import Session, select
-from myapp.models import DetailedData, SummaryData
-from myapp.database import engine
+from myapp.models import DeletedRecord, DetailedData, IngestionJob, IngestionJobStage, IngestionRun, SummaryData
+from myapp.database import engine, read_session
 import pandas as pd
+import datetime
 import logging
+import os
 
-from myapp.pydantic_models import DetailedDataModel, SummaryDataModel
+from myapp.pydantic_models import DetailedDataModel, IngestionJobModel, IngestionJobStageModel, PartialDetailedDataModel, PartialSummaryDataModel, SummaryDataModel
+
+# Response models used when only some fields are requested
+PARTIAL_MODELS = {SummaryDataModel: PartialSummaryDataModel, DetailedDataModel: PartialDetailedDataModel}
+
+# Statuses of the jobs that aren't over yet
+UNFINISHED_JOB_STATUSES = ['queued', 'running']
+
+# Tables of the change feed, in the order they are paged through
+CHANGE_TABLES = {'summary': (SummaryData, SummaryDataModel), 'detailed': (DetailedData, DetailedDataModel)}
+
+# Largest share of the stored rows of a table an ingestion run may delete without being forced
+MAX_DELETE_SHARE = float(os.environ.get("INGESTION_MAX_DELETE_SHARE", "0.1"))
+
+# Key of the PostgreSQL advisory lock held while an ingestion run is written
+SYNC_LOCK_KEY = 72637001
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -19,204 +36,629 @@ def data_already_loaded() -> bool:
         result = session.exec(select(SummaryData).limit(1)).first()
         return result is not None
 
-def insert_summary_data(df: pd.DataFrame) -> None:
+# Columns copied from the processed DataFrames into the tables, 'id' is handled separately
+DATA_COLUMNS = [
+    'structure', 'element_status', 'base_name', 'attribute_name', 'other_name', 'category_code', 'tags', 'unit',
+    'creation_date', 'last_update_date', 'validity_period', 'uncertainty', 'reglementations', 'transparency',
+    'quality', 'quality_ter', 'quality_gr', 'quality_tir', 'quality_c', 'quality_p', 'quality_m', 'comment',
+    'emission_type', 'emission_type_name', 'unaggregated_total', 'co2f', 'ch4f', 'ch4b', 'n2o',
+    'other_greenhouse_gas', 'co2b', 'sf6'
+]
+SUMMARY_COLUMNS = DATA_COLUMNS + ['contributor', 'program', 'program_url', 'source', 'location', 'sub_location']
+
+def hash_rows(df: pd.DataFrame, columns: list) -> list:
+    """
+    Computes a hash of the content of each row, used to detect rows that changed between ingestion runs.
+    """
+    hashes = pd.util.hash_pandas_object(df[columns], index=False)
+    return [format(h, '016x') for h in hashes]
+
+def delete_records(session: Session, model, records: list, version: int) -> None:
+    """
+    Deletes rows from a table and keeps a tombstone for each of them.
+
+    Args:
+        session (Session): The session of the ingestion run.
+        model: The table to delete from, either SummaryData or DetailedData.
+        records (list): (id, summary_id) of the rows to delete.
+        version (int): The version of the ingestion run.
+    """
+    if not records:
+        return
+    ids = [record_id for record_id, _ in records]
+    session.exec(delete(model).where(model.id.in_(ids)))
+    session.add_all([
+        DeletedRecord(table_name=model.__tablename__, record_id=record_id, summary_id=summary_id, version=version)
+        for record_id, summary_id in records
+    ])
+
+def sync_summary_data(session: Session, df: pd.DataFrame, run: IngestionRun) -> list:
+    """
+    Inserts new rows and updates changed rows of the summarydata table from a dataframe.
+
+    Args:
+        session (Session): The session of the ingestion run.
+        df (pd.DataFrame): The summary DataFrame.
+        run (IngestionRun): The ingestion run, whose id is the version given to the changed rows.
+
+    Returns:
+        list: (id, summary_id) of the existing rows that are no longer in the dataframe.
+    """
+    logging.info("Syncing summary data...")
+    now = datetime.datetime.utcnow()
+    existing = dict(session.exec(select(SummaryData.id, SummaryData.content_hash)).all())
+
+    duplicated = df['id'].duplicated()
+    if duplicated.any():
+        logging.warning(f"Skipping {duplicated.sum()} summary rows with a repeated id")
+        df = df[~duplicated]
+
+    inserted_ids = []
+    updates = []
+    for (index, row), content_hash in zip(df.iterrows(), hash_rows(df, SUMMARY_COLUMNS)):
+        id = int(row['id'])
+        is_new = id not in existing
+        if existing.pop(id, None) == content_hash:
+            continue
+
+        values = {col: row[col] for col in SUMMARY_COLUMNS}
+        values.update(version=run.id, updated_at=now, content_hash=content_hash)
+        if is_new:
+            session.add(SummaryData(id=id, **values))
+            inserted_ids.append(id)
+        else:
+            updates.append(dict(values, id=id))
+
+    # Changed rows are updated by primary key in bulk rather than loaded one by one
+    if updates:
+        session.execute(update(SummaryData), updates)
+    run.inserted += len(inserted_ids)
+    run.updated += len(updates)
+    # Ids that come back are no longer deleted
+    if inserted_ids:
+        session.exec(delete(DeletedRecord).where(
+            DeletedRecord.table_name == SummaryData.__tablename__,
+            DeletedRecord.record_id.in_(inserted_ids)
+        ))
+
+    return [(id, id) for id in existing]
+
+def sync_detailed_data(session: Session, df: pd.DataFrame, run: IngestionRun) -> list:
+    """
+    Inserts, updates and deletes rows of the detaileddata table from a dataframe.
+
+    Detailed rows have no id in the source, so the rows of each summary id are matched
+    with the stored ones by position, in source order.
+
+    Args:
+        session (Session): The session of the ingestion run.
+        df (pd.DataFrame): The detailed DataFrame.
+        run (IngestionRun): The ingestion run, whose id is the version given to the changed rows.
+
+    Returns:
+        list: (id, summary_id) of the deleted rows.
+    """
+    logging.info("Syncing detailed data...")
+    now = datetime.datetime.utcnow()
+    existing = {}
+    statement = select(DetailedData.id, DetailedData.summary_id, DetailedData.content_hash).order_by(DetailedData.id)
+    for id, summary_id, content_hash in session.exec(statement):
+        existing.setdefault(summary_id, []).append((id, content_hash))
+
+    positions = {}
+    updates = []
+    for (index, row), content_hash in zip(df.iterrows(), hash_rows(df, ['id'] + DATA_COLUMNS)):
+        summary_id = int(row['id'])
+        position = positions.get(summary_id, 0)
+        positions[summary_id] = position + 1
+        stored = existing.get(summary_id, [])
+
+        values = {col: row[col] for col in DATA_COLUMNS}
+        values.update(version=run.id, updated_at=now, content_hash=content_hash)
+        if position < len(stored):
+            id, stored_hash = stored[position]
+            if stored_hash == content_hash:
+                continue
+            updates.append(dict(values, id=id))
+        else:
+            session.add(DetailedData(summary_id=summary_id, **values))
+            run.inserted += 1
+
+    # Changed rows are updated by primary key in bulk rather than loaded one by one
+    if updates:
+        session.execute(update(DetailedData), updates)
+    run.updated += len(updates)
+
+    removed = [
+        (id, summary_id)
+        for summary_id, stored in existing.items()
+        for id, _ in stored[positions.get(summary_id, 0):]
+    ]
+    delete_records(session, DetailedData, removed, run.id)
+    run.deleted += len(removed)
+    return removed
+
+def check_deletions(model, removed: int, stored: int, force: bool) -> None:
+    """
+    Refuses an ingestion run deleting more than MAX_DELETE_SHARE of the stored rows of a table, e.g. from a truncated workbook.
+
+    Args:
+        model: The table, either SummaryData or DetailedData.
+        removed (int): The number of rows the run deletes.
+        stored (int): The number of rows in the table before the run.
+        force (bool): Allow the run anyway.
+
+    Raises:
+        ValueError: If too many rows would be deleted and the run isn't forced.
+    """
+    if force or stored == 0 or removed / stored <= MAX_DELETE_SHARE:
+        return
+    raise ValueError(
+        f"The workbook would delete {removed} of the {stored} rows of {model.__tablename__}, "
+        f"more than {MAX_DELETE_SHARE:.0%}. Force the ingestion to load it anyway"
+    )
+
+def sync_data(summary_df: pd.DataFrame, detailed_df: pd.DataFrame, force: bool = False) -> int:
     """
-    Inserts a dataframe into the database using the SummaryData model.
+    Applies the result of an ingestion run to the database in a single transaction.
+
+    Every inserted or updated row gets the id of the run as its version, and deleted rows
+    are kept as tombstones, so clients can fetch only what changed since their last sync.
+
+    Args:
+        summary_df (pd.DataFrame): The summary DataFrame.
+        detailed_df (pd.DataFrame): The detailed DataFrame.
+        force (bool): Load the data even if it deletes more than MAX_DELETE_SHARE of the stored rows.
+
+    Returns:
+        int: The version of the ingestion run.
+
+    Raises:
+        ValueError: If the run deletes too many rows and isn't forced, nothing is written then.
     """
-    logging.info("Inserting summary data...")
+    orphans = ~detailed_df['id'].isin(summary_df['id'])
+    if orphans.any():
+        logging.warning(f"Skipping {orphans.sum()} detailed rows without a summary row")
+        detailed_df = detailed_df[~orphans]
+
     with Session(engine) as session:
-        for index, row in df.iterrows():
-            try:
-                data = SummaryData(
-                    id=int(row['id']),
-                    structure=row['structure'],
-                    element_status=row['element_status'],
-                    base_name=row['base_name'],
-                    attribute_name=row['attribute_name'],
-                    other_name=row['other_name'],
-                    category_code=row['category_code'],
-                    tags=row['tags'],
-                    unit=row['unit'],
-                    contributor=row['contributor'],
-                    program=row['program'],
-                    program_url=row['program_url'],
-                    source=row['source'],
-                    location=row['location'],
-                    sub_location=row['sub_location'],
-                    creation_date=row['creation_date'],
-                    last_update_date=row['last_update_date'],
-                    validity_period=row['validity_period'],
-                    uncertainty=row['uncertainty'],
-                    reglementations=row['reglementations'],
-                    transparency=row['transparency'],
-                    quality=row['quality'],
-                    quality_ter=row['quality_ter'],
-                    quality_gr=row['quality_gr'],
-                    quality_tir=row['quality_tir'],
-                    quality_c=row['quality_c'],
-                    quality_p=row['quality_p'],
-                    quality_m=row['quality_m'],
-                    comment=row['comment'],
-                    emission_type=row['emission_type'],
-                    emission_type_name=row['emission_type_name'],
-                    unaggregated_total=row['unaggregated_total'],
-                    co2f=row['co2f'],
-                    ch4f=row['ch4f'],
-                    ch4b=row['ch4b'],
-                    n2o=row['n2o'],
-                    other_greenhouse_gas=row['other_greenhouse_gas'],
-                    co2b=row['co2b'],
-                    sf6=row['sf6']
-                )
-                session.add(data)
-            except Exception as e:
-              logging.error(f"Error inserting row at index {index}: {e}")
-              logging.info(f"Row data: {row.to_dict()}")
-              session.rollback()
-              continue
+        # Runs are diffed against the rows in the database and detailed rows have no unique key,
+        # so concurrent runs are serialised until the transaction ends to not insert them twice
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': SYNC_LOCK_KEY})
+
+        run = IngestionRun()
+        session.add(run)
+        session.flush()
+
+        stored_summary = session.exec(select(func.count()).select_from(SummaryData)).one()
+        stored_detailed = session.exec(select(func.count()).select_from(DetailedData)).one()
+
+        removed_summary = sync_summary_data(session, summary_df, run)
+        session.flush()
+        removed_detailed = sync_detailed_data(session, detailed_df, run)
+        session.flush()
+
+        # Nothing is committed yet, the whole run is rolled back if it deletes too much
+        check_deletions(SummaryData, len(removed_summary), stored_summary, force)
+        check_deletions(DetailedData, len(removed_detailed), stored_detailed, force)
+
+        # Detailed rows are removed first since they reference the summary rows
+        delete_records(session, SummaryData, removed_summary, run.id)
+        run.deleted += len(removed_summary)
+
+        session.add(run)
         session.commit()
+        logging.info(f"Ingestion run {run.id}: {run.inserted} inserted, {run.updated} updated, {run.deleted} deleted")
+        return run.id
 
-def insert_detailed_data(df: pd.DataFrame) -> None:
+def fetch_latest_version(primary: bool = False) -> int:
     """
-    Inserts a dataframe into the database using the DetailedData model.
+    Fetches the version of the last ingestion run, 0 if no data was loaded yet.
+
+    Args:
+        primary (bool): Read from the primary rather than a replica.
     """
+    with read_session(primary) as session:
+        return session.exec(select(func.max(IngestionRun.id))).one() or 0
 
-    logging.info('Inserting detailed data...')
-    with Session(engine) as session:
-        for index, row in df.iterrows():
-            try:
-                data = DetailedData(
-                    summary_id=int(row['id']),
-                    structure=row['structure'],
-                    element_status=row['element_status'],
-                    base_name=row['base_name'],
-                    attribute_name=row['attribute_name'],
-                    other_name=row['other_name'],
-                    category_code=row['category_code'],
-                    tags=row['tags'],
-                    unit=row['unit'],
-                    creation_date=row['creation_date'],
-                    last_update_date=row['last_update_date'],
-                    validity_period=row['validity_period'],
-                    uncertainty=row['uncertainty'],
-                    reglementations=row['reglementations'],
-                    transparency=row['transparency'],
-                    quality=row['quality'],
-                    quality_ter=row['quality_ter'],
-                    quality_gr=row['quality_gr'],
-                    quality_tir=row['quality_tir'],
-                    quality_c=row['quality_c'],
-                    quality_p=row['quality_p'],
-                    quality_m=row['quality_m'],
-                    comment=row['comment'],
-                    emission_type=row['emission_type'],
-                    emission_type_name=row['emission_type_name'],
-                    unaggregated_total=row['unaggregated_total'],
-                    co2f=row['co2f'],
-                    ch4f=row['ch4f'],
-                    ch4b=row['ch4b'],
-                    n2o=row['n2o'],
-                    other_greenhouse_gas=row['other_greenhouse_gas'],
-                    co2b=row['co2b'],
-                    sf6=row['sf6']
-                )
-                session.add(data)
-                session.commit()
-            except Exception as e:
-                logging.error(f"Error inserting row at index {index}: {e}")
-                session.rollback()
-                continue
+def parse_fields(fields: str, *data_models) -> list:
+    """
+    Parses a comma separated list of fields to return.
+
+    Args:
+        fields (str): The comma separated field names, None for all fields.
+        data_models: The response models the fields belong to.
+
+    Returns:
+        list: The field names, None for all fields.
+
+    Raises:
+        ValueError: If a field is in none of the response models.
+    """
+    if fields is None:
+        return None
+    available = list(dict.fromkeys(name for data_model in data_models for name in data_model.model_fields))
+    names = list(dict.fromkeys(name.strip() for name in fields.split(',') if name.strip()))
+    unknown = [name for name in names if name not in available]
+    if unknown or not names:
+        raise ValueError(f"Unknown fields: {unknown}, available fields: {available}")
+    return names
+
+def select_fields(model, fields: list):
+    """
+    Builds a SELECT statement reading only the given fields of a table, or whole rows if fields is None.
+    """
+    if fields is None:
+        return select(model)
+    # SQLAlchemy's select always returns rows, even for a single column
+    return select_columns(*[getattr(model, field) for field in fields])
 
-def fetch_all_summary_data() -> list:
+def validate_record(data_model, record, fields: list):
+    """
+    Converts a row to its response model, only validating the selected fields.
+    """
+    if fields is None:
+        return data_model.model_validate(record)
+    return PARTIAL_MODELS[data_model].model_validate(record._mapping)
+
+def fetch_all_summary_data(fields: list = None) -> list:
     """
     Fetches all data in the summarydata table
+
+    Args:
+        fields (list): The fields to read, None for all fields.
     """
-    with Session(engine) as session:
-        statement = select(SummaryData)
+    with read_session() as session:
+        statement = select_fields(SummaryData, fields)
         results = session.exec(statement)
         data = results.all()
         if data:
               try:
-                  return [SummaryDataModel.model_validate(record) for record in data]
+                  return [validate_record(SummaryDataModel, record, fields) for record in data]
               except ValidationError as e:
                   logging.error(f"Validation error: {e}")
                   return None
         return None
 
-def fetch_one_summary_data(id: int):
+def fetch_one_summary_data(id: int, fields: list = None):
     """
     Fetches a single row of data in the summarydata table
 
     Args:
         item_id (int): The id (key) of the desired row of data
+        fields (list): The fields to read, None for all fields.
 
     """
-    with Session(engine) as session:
-        statement = select(SummaryData).where(SummaryData.id == id)
+    with read_session() as session:
+        statement = select_fields(SummaryData, fields).where(SummaryData.id == id)
         result = session.exec(statement)
         record = result.first()
         if record:
               try:
-                  return SummaryDataModel.model_validate(record)
+                  return validate_record(SummaryDataModel, record, fields)
               except ValidationError as e:
                   logging.error(f"Validation error: {e}")
                   return None
         return None
 
-def fetch_detailed_data_by_summary_id(summary_id: int) -> list:
+def fetch_detailed_data_by_summary_id(summary_id: int, fields: list = None) -> list:
     """
     Fetches all rows of data linked to a parent row of data in the summary field.
 
     Args:
         summary_id (int): The id of the parent row in the summarydata table.
+        fields (list): The fields to read, None for all fields.
 
     """
-    with Session(engine) as session:
-        statement = select(DetailedData).where(DetailedData.summary_id == summary_id)
+    with read_session() as session:
+        statement = select_fields(DetailedData, fields).where(DetailedData.summary_id == summary_id)
         results = session.exec(statement)
         data = results.all()
         if data:
               try:
-                  return [DetailedDataModel.model_validate(record) for record in data]
+                  return [validate_record(DetailedDataModel, record, fields) for record in data]
               except ValidationError as e:
                   logging.error(f"Validation error: {e}")
                   return None
         return None
 
-def fetch_one_detailed_data(id: int):
+def fetch_snapshot_data() -> tuple:
+    """
+    Fetches all the summary and detailed rows from the primary in one transaction, with the
+    version they are at, so they are consistent with each other even while runs are loaded.
+
+    Returns:
+        version (int): The version of the last ingestion run in the transaction.
+        summary (list): The summary rows.
+        detailed (list): The detailed rows, ordered by summary id.
+    """
+    with Session(engine) as session:
+        # Read committed would let each query see the runs committed since the previous one
+        if session.get_bind().dialect.name == 'postgresql':
+            session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+        version = session.exec(select(func.max(IngestionRun.id))).one() or 0
+        summary = [SummaryDataModel.model_validate(record) for record in session.exec(select(SummaryData))]
+        statement = select(DetailedData).order_by(DetailedData.summary_id, DetailedData.id)
+        detailed = [DetailedDataModel.model_validate(record) for record in session.exec(statement)]
+        return version, summary, detailed
+
+def fetch_one_detailed_data(id: int, fields: list = None):
     """
     Fetches all rows of data linked to a parent row of data in the summary field.
 
     Args:
         item_id (int): The id (key) of the desired row of data
+        fields (list): The fields to read, None for all fields.
 
     """
-    with Session(engine) as session:
-        statement = select(DetailedData).where(DetailedData.id == id)
+    with read_session() as session:
+        statement = select_fields(DetailedData, fields).where(DetailedData.id == id)
         result = session.exec(statement)
         record = result.first()
         if record:
               try:
-                  return DetailedDataModel.model_validate(record)
+                  return validate_record(DetailedDataModel, record, fields)
               except ValidationError as e:
                   logging.error(f"Validation error: {e}")
                   return None
         return None
 
-def fetch_summary_data_by_filter(column_name: str, filter_value: str):
-    with Session(engine) as session:
+def fetch_summary_data_by_filter(column_name: str, filter_value: str, fields: list = None):
+    with read_session() as session:
         # Create a condition to filter by the specified column and value
         condition = and_(getattr(SummaryData, column_name) == filter_value)
 
         # Use the condition in the SELECT statement
-        statement = select(SummaryData).where(condition)
+        statement = select_fields(SummaryData, fields).where(condition)
 
         results = session.exec(statement)
         data = results.all()
         if data:
             try:
-                return [SummaryDataModel.model_validate(record) for record in data]
+                return [validate_record(SummaryDataModel, record, fields) for record in data]
             except ValidationError as e:
                 logging.error(f"Validation error: {e}")
                 return []
         return []
+
+def fetch_emission_factors(model, min_version: int = None) -> list:
+    """
+    Fetches only the columns needed to compute emissions from a factor table.
+
+    Args:
+        model: The table to read from, either SummaryData or DetailedData.
+        min_version (int): The oldest ingestion run the factors may be read at.
+
+    Returns:
+        list: Rows of (id, unaggregated_total, co2f, ch4f, ch4b, n2o, co2b, sf6, other_greenhouse_gas, uncertainty).
+    """
+    with read_session(min_version=min_version) as session:
+        statement = select(
+            model.id,
+            model.unaggregated_total,
+            model.co2f,
+            model.ch4f,
+            model.ch4b,
+            model.n2o,
+            model.co2b,
+            model.sf6,
+            model.other_greenhouse_gas,
+            model.uncertainty
+        )
+        return session.exec(statement).all()
+
+def fetch_table_changes(session: Session, model, since: int, version: int, after_id: int, limit: int, fields: list = None) -> tuple:
+    """
+    Fetches the rows of a table changed or deleted between two versions, in id order.
+
+    Args:
+        fields (list): The fields to read from the changed rows, None for all fields. Must include 'id'.
+
+    Returns:
+        records (list): Inserted or updated rows.
+        deleted (list): Ids of the deleted rows.
+        next_id (int): The id to continue from, None if there are no more changes.
+    """
+    records = session.exec(
+        select_fields(model, fields)
+        .where(model.version > since, model.version <= version, model.id > after_id)
+        .order_by(model.id)
+        .limit(limit)
+    ).all()
+    deleted = session.exec(
+        select(DeletedRecord.record_id)
+        .where(
+            DeletedRecord.table_name == model.__tablename__,
+            DeletedRecord.version > since,
+            DeletedRecord.version <= version,
+            DeletedRecord.record_id > after_id
+        )
+        .order_by(DeletedRecord.record_id)
+        .limit(limit)
+    ).all()
+
+    ids = sorted([record.id for record in records] + list(deleted))
+    if len(ids) < limit:
+        return records, list(deleted), None
+
+    # Only keep the first ids of both lists, the rest goes to the next page
+    last_id = ids[limit - 1]
+    records = [record for record in records if record.id <= last_id]
+    deleted = [record_id for record_id in deleted if record_id <= last_id]
+    return records, deleted, last_id
+
+def fetch_changes(since: int, cursor: str = None, limit: int = 1000, fields: list = None) -> dict:
+    """
+    Fetches a page of the rows inserted, updated or deleted since a version.
+
+    The summary rows are paged through first, then the detailed rows. The cursor also fixes
+    the version the pages go up to, so runs loaded while a client is paging are left for its next sync.
+
+    Args:
+        since (int): The version of the client's last sync.
+        cursor (str): The next_cursor of the previous page, None for the first page.
+        limit (int): The maximum number of changes in the page.
+        fields (list): The fields of the changed rows to return, None for all fields. 'id' is always returned.
+
+    Returns:
+        dict: The changes per table, the version they go up to and the cursor of the next page.
+    """
+    version = None
+    if cursor is not None:
+        try:
+            version, table, after_id = cursor.split(':')
+            version, after_id = int(version), int(after_id)
+        except ValueError:
+            raise ValueError(f"Invalid cursor '{cursor}'")
+        if table not in CHANGE_TABLES:
+            raise ValueError(f"Invalid cursor '{cursor}'")
+
+    # The pages of a sync may be read from different replicas, they must all have the version of the first page
+    with read_session(min_version=version) as session:
+        if cursor is None:
+            version = session.exec(select(func.max(IngestionRun.id))).one() or 0
+            table, after_id = 'summary', 0
+
+        changes = {'version': version, 'next_cursor': None}
+        tables = list(CHANGE_TABLES)
+        for key in tables:
+            changes[key] = {'upserted': [], 'deleted': []}
+
+        for position, key in enumerate(tables[tables.index(table):]):
+            model, data_model = CHANGE_TABLES[key]
+            if position > 0:
+                after_id = 0
+            table_fields = None
+            if fields is not None:
+                table_fields = ['id'] + [field for field in fields if field in data_model.model_fields and field != 'id']
+
+            records, deleted, next_id = fetch_table_changes(session, model, since, version, after_id, limit, table_fields)
+            changes[key] = {
+                'upserted': [validate_record(data_model, record, table_fields) for record in records],
+                'deleted': deleted
+            }
+            limit -= len(records) + len(deleted)
+            if next_id is not None:
+                changes['next_cursor'] = f"{version}:{key}:{next_id}"
+                break
+
+        return changes
+
+def create_ingestion_job(filename: str) -> int:
+    """
+    Creates a queued ingestion job.
+
+    Args:
+        filename (str): The name of the uploaded file.
+
+    Returns:
+        int: The id of the job.
+    """
+    with Session(engine) as session:
+        job = IngestionJob(filename=filename)
+        session.add(job)
+        session.commit()
+        return job.id
+
+def update_ingestion_job(job_id: int, from_status: list = None, **values) -> bool:
+    """
+    Updates the columns of an ingestion job, e.g. its status.
+
+    Args:
+        job_id (int): The id of the job.
+        from_status (list): Only update the job if it has one of these statuses, any status if None.
+
+    Returns:
+        bool: Whether the job was updated.
+    """
+    statement = update(IngestionJob).where(IngestionJob.id == job_id).values(**values)
+    if from_status is not None:
+        statement = statement.where(IngestionJob.status.in_(from_status))
+    with Session(engine) as session:
+        count = session.execute(statement).rowcount
+        session.commit()
+        return count > 0
+
+def touch_ingestion_jobs(job_ids: list) -> None:
+    """
+    Refreshes the heartbeat of unfinished ingestion jobs, showing the process owning them is alive.
+    """
+    with Session(engine) as session:
+        statement = (
+            update(IngestionJob)
+            .where(IngestionJob.id.in_(job_ids), IngestionJob.status.in_(UNFINISHED_JOB_STATUSES))
+            .values(heartbeat_at=datetime.datetime.utcnow())
+        )
+        session.execute(statement)
+        session.commit()
+
+def fail_interrupted_ingestion_jobs(stale_before: datetime.datetime) -> None:
+    """
+    Marks the unfinished jobs whose heartbeat stopped as failed, as the process that owned them is gone.
+
+    Args:
+        stale_before (datetime.datetime): Jobs whose last heartbeat is older than this are failed.
+    """
+    with Session(engine) as session:
+        statement = (
+            update(IngestionJob)
+            .where(IngestionJob.status.in_(UNFINISHED_JOB_STATUSES), IngestionJob.heartbeat_at < stale_before)
+            .values(status='failed', finished_at=datetime.datetime.utcnow(), error='Interrupted, the process running the job stopped')
+        )
+        count = session.execute(statement).rowcount
+        session.commit()
+        if count:
+            logging.warning(f"Marked {count} interrupted ingestion jobs as failed")
+
+def record_job_stage(job_id: int, name: str, status: str, rows: int, seconds: float) -> None:
+    """
+    Records the progress of a stage of an ingestion job, creating the stage when it starts.
+    """
+    with Session(engine) as session:
+        statement = select(IngestionJobStage).where(IngestionJobStage.job_id == job_id, IngestionJobStage.name == name)
+        stage = session.exec(statement).first()
+        if stage is None:
+            stage = IngestionJobStage(job_id=job_id, name=name, status=status)
+        stage.status = status
+        stage.rows = rows
+        stage.seconds = seconds
+        session.add(stage)
+        session.commit()
+
+def ingestion_job_model(session: Session, job: IngestionJob) -> IngestionJobModel:
+    """
+    Converts an ingestion job to its response model, with its stages and the row counts of its run.
+    """
+    data = IngestionJobModel.model_validate(job)
+    statement = select(IngestionJobStage).where(IngestionJobStage.job_id == job.id).order_by(IngestionJobStage.id)
+    data.stages = [IngestionJobStageModel.model_validate(stage) for stage in session.exec(statement)]
+    if job.version is not None:
+        run = session.get(IngestionRun, job.version)
+        data.inserted, data.updated, data.deleted = run.inserted, run.updated, run.deleted
+    return data
+
+def fetch_ingestion_job(job_id: int):
+    """
+    Fetches an ingestion job and the progress of its stages.
+
+    Jobs are read from the primary, where the workers write their progress, so a job is
+    seen as soon as it is created and its status is never behind.
+
+    Args:
+        job_id (int): The id of the job.
+
+    """
+    with read_session(primary=True) as session:
+        job = session.get(IngestionJob, job_id)
+        if job:
+            return ingestion_job_model(session, job)
+        return None
+
+def fetch_ingestion_jobs(limit: int = 20) -> list:
+    """
+    Fetches the most recent ingestion jobs, newest first, from the primary like fetch_ingestion_job.
+    """
+    with read_session(primary=True) as session:
+        statement = select(IngestionJob).order_by(IngestionJob.id.desc()).limit(limit)
+        return [ingestion_job_model(session, job) for job in session.exec(statement).all()]
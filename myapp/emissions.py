@@ -0,0 +1,213 @@
+import logging
+import numpy as np
+
+from myapp.db_operations import fetch_emission_factors, fetch_latest_version
+from myapp.models import DetailedData, SummaryData
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Order of the result columns returned by calculate_emissions
+GAS_COLUMNS = ['co2f', 'ch4f', 'ch4b', 'n2o', 'co2b', 'sf6', 'other_greenhouse_gas']
+RESULT_COLUMNS = GAS_COLUMNS + ['total']
+
+# Factor tables kept in memory, keyed by table name, and the data version they were read at
+_factor_tables = {}
+_factor_version = None
+
+def load_factor_table(model, version: int) -> tuple:
+    """
+    Reads a factor table into NumPy arrays sorted by id.
+
+    Args:
+        model: The table to read from, either SummaryData or DetailedData.
+        version (int): The ingestion run the factors must be read at least at.
+
+    Returns:
+        ids (np.ndarray): Sorted ids of the table.
+        factors (np.ndarray): One row per id, with columns in RESULT_COLUMNS order.
+        uncertainty (np.ndarray): Relative uncertainty per id, NaN when unknown.
+    """
+    rows = fetch_emission_factors(model, min_version=version)
+    data = np.array(rows, dtype=float).reshape(-1, 10)
+    data = data[np.argsort(data[:, 0], kind='stable')]
+
+    ids = data[:, 0].astype(np.int64)
+    # Gas columns come after (id, unaggregated_total), the total goes last
+    factors = np.ascontiguousarray(data[:, [2, 3, 4, 5, 6, 7, 8, 1]])
+    uncertainty = data[:, 9]
+
+    logging.info(f"Loaded {len(ids)} emission factors from {model.__tablename__}")
+    return ids, factors, uncertainty
+
+def get_factor_table(model) -> tuple:
+    """
+    Returns the in-memory factor table for a model, loading it on first use and after each ingestion run.
+    """
+    global _factor_version
+    version = fetch_latest_version()
+    # Replicas can be at different versions, an older one doesn't invalidate the tables
+    if _factor_version is None or version > _factor_version:
+        _factor_tables.clear()
+        _factor_version = version
+
+    table_name = model.__tablename__
+    if table_name not in _factor_tables:
+        _factor_tables[table_name] = load_factor_table(model, _factor_version)
+    return _factor_tables[table_name]
+
+def lookup_factors(model, requested_ids: np.ndarray) -> tuple:
+    """
+    Finds the factors for each requested id.
+
+    Raises:
+        LookupError: If any of the requested ids is not in the table.
+    """
+    ids, factors, uncertainty = get_factor_table(model)
+    if len(ids) == 0:
+        positions = np.zeros(len(requested_ids), dtype=np.int64)
+        found = np.zeros(len(requested_ids), dtype=bool)
+    else:
+        positions = np.searchsorted(ids, requested_ids).clip(max=len(ids) - 1)
+        found = ids[positions] == requested_ids
+
+    if not found.all():
+        missing = np.unique(requested_ids[~found])
+        raise LookupError(f"Unknown {model.__tablename__} ids: {missing[:20].tolist()}")
+
+    return factors[positions], uncertainty[positions]
+
+def calculate_emissions(ids: np.ndarray, is_detailed: np.ndarray, quantities: np.ndarray) -> tuple:
+    """
+    Multiplies each activity quantity by the emission factors of its id.
+
+    Args:
+        ids (np.ndarray): Summary or detailed id of each line.
+        is_detailed (np.ndarray): True where the id refers to the detaileddata table.
+        quantities (np.ndarray): Activity quantity of each line, in the unit of the factor.
+
+    Returns:
+        results (np.ndarray): One row per line, with columns in RESULT_COLUMNS order.
+        uncertainty (np.ndarray): Relative uncertainty of each line, NaN when unknown.
+    """
+    factors = np.empty((len(ids), len(RESULT_COLUMNS)))
+    uncertainty = np.empty(len(ids))
+
+    for model, mask in ((SummaryData, ~is_detailed), (DetailedData, is_detailed)):
+        if mask.any():
+            factors[mask], uncertainty[mask] = lookup_factors(model, ids[mask])
+
+    return factors * quantities[:, np.newaxis], uncertainty
+
+def aggregate_emissions(results: np.ndarray, uncertainty: np.ndarray, group_index: np.ndarray, group_count: int) -> tuple:
+    """
+    Sums line results per group and propagates their uncertainty.
+
+    Line uncertainties are treated as independent, so the absolute uncertainty of a group is
+    the root sum of squares of the absolute uncertainty of its lines. Lines with an unknown
+    uncertainty do not contribute to it.
+
+    Args:
+        results (np.ndarray): Line results, as returned by calculate_emissions.
+        uncertainty (np.ndarray): Relative uncertainty of each line.
+        group_index (np.ndarray): Index of the group of each line.
+        group_count (int): Number of groups.
+
+    Returns:
+        totals (np.ndarray): One row per group, with columns in RESULT_COLUMNS order.
+        uncertainty (np.ndarray): Relative uncertainty of each group, NaN when it can't be computed.
+    """
+    totals = np.column_stack([
+        np.bincount(group_index, weights=results[:, i], minlength=group_count)
+        for i in range(results.shape[1])
+    ])
+
+    absolute_uncertainty = np.nan_to_num(uncertainty * np.abs(results[:, -1]))
+    variance = np.bincount(group_index, weights=absolute_uncertainty ** 2, minlength=group_count)
+    known = np.bincount(group_index, weights=~np.isnan(uncertainty), minlength=group_count) > 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        group_uncertainty = np.sqrt(variance) / np.abs(totals[:, -1])
+    group_uncertainty[~known | ~np.isfinite(group_uncertainty)] = np.nan
+
+    return totals, group_uncertainty
+
+def _to_records(results: np.ndarray, uncertainty: np.ndarray) -> list:
+    """
+    Converts result rows to dictionaries, replacing unknown uncertainties with None.
+    """
+    return [
+        dict(zip(RESULT_COLUMNS, row), uncertainty=u)
+        for row, u in zip(results.tolist(), _to_list(uncertainty))
+    ]
+
+def _to_list(uncertainty: np.ndarray) -> list:
+    """
+    Converts uncertainties to a list, replacing unknown ones with None as NaN isn't valid JSON.
+    """
+    return np.where(np.isnan(uncertainty), None, uncertainty).tolist()
+
+def _to_ids(values: list, count: int) -> tuple:
+    """
+    Converts a list of optional ids to an int64 array and a mask of the given ids.
+    """
+    if values is None:
+        return np.zeros(count, dtype=np.int64), np.zeros(count, dtype=bool)
+    values = np.array(values, dtype=object)
+    given = np.not_equal(values, None)
+    values[~given] = 0
+    return values.astype(np.int64), given
+
+def calculate_batch_emissions(batch) -> dict:
+    """
+    Calculates the emissions of a batch of activity lines, with overall and per-group totals.
+
+    Args:
+        batch: An EmissionsBatchModel, holding one list entry per line.
+
+    Returns:
+        dict: Per-line results in input order, one list per column, the batch totals and,
+            if any line has a group, the totals per group.
+
+    Raises:
+        ValueError: If the lists don't have one entry per line, or a line doesn't have exactly one of summary_id or detailed_id.
+        LookupError: If a line refers to an unknown id.
+    """
+    count = len(batch.quantities)
+    for name in ('summary_ids', 'detailed_ids', 'groups'):
+        values = getattr(batch, name)
+        if values is not None and len(values) != count:
+            raise ValueError(f"{name} has {len(values)} entries, expected one per quantity ({count})")
+
+    summary_ids, has_summary = _to_ids(batch.summary_ids, count)
+    detailed_ids, is_detailed = _to_ids(batch.detailed_ids, count)
+    invalid = np.flatnonzero(has_summary == is_detailed)
+    if len(invalid) > 0:
+        raise ValueError(f"Lines must have exactly one of summary_id or detailed_id, invalid lines: {invalid[:20].tolist()}")
+
+    ids = np.where(is_detailed, detailed_ids, summary_ids)
+    quantities = np.array(batch.quantities, dtype=float)
+
+    results, uncertainty = calculate_emissions(ids, is_detailed, quantities)
+
+    totals, total_uncertainty = aggregate_emissions(results, uncertainty, np.zeros(count, dtype=np.int64), 1)
+    lines = dict(zip(RESULT_COLUMNS, results.T.tolist()))
+    lines['uncertainty'] = _to_list(uncertainty)
+    data = {
+        'lines': lines,
+        'totals': _to_records(totals, total_uncertainty)[0],
+        'groups': None
+    }
+
+    # Lines without a group only count towards the batch totals
+    if batch.groups is not None:
+        groups = np.array(batch.groups, dtype=object)
+        rows = np.flatnonzero(np.not_equal(groups, None))
+        if len(rows) > 0:
+            labels, group_index = np.unique(groups[rows].astype(str), return_inverse=True)
+            group_totals, group_uncertainty = aggregate_emissions(results[rows], uncertainty[rows], group_index, len(labels))
+            data['groups'] = [
+                dict(record, group=label)
+                for label, record in zip(labels.tolist(), _to_records(group_totals, group_uncertainty))
+            ]
+
+    return data
@@ -1,12 +1,27 @@
 import pandas as pd
+import multiprocessing
+import os
 import re
+import time
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from itertools import repeat
 from pathlib import Path
 
-from myapp.db_operations import data_already_loaded, insert_summary_data, insert_detailed_data
+from myapp.db_operations import data_already_loaded, fetch_latest_version, sync_data
 from myapp.database import create_db_and_tables
+from myapp.profiling import PROFILING_ENABLED, PROFILING_INGESTION, PROFILING_MODE, profile
+from myapp.snapshots import build_snapshots, snapshot_exists
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Number of processes cleaning the data, 1 runs every step in the calling process
+TRANSFORM_WORKERS = int(os.environ.get("TRANSFORM_WORKERS", "1"))
+
+# Stages of an ingestion, in order
+STAGES = ['parse', 'clean', 'split', 'validate', 'load', 'snapshot']
+
 # Helper functions
 def to_snake_case(name: str) -> str:
     """Converts a string to snake_case."""
@@ -66,16 +81,25 @@ def convert_date_language(df: pd.DataFrame) -> pd.DataFrame:
         df[col] = df[col].str.title().replace(french_to_english, regex=True)
     return df
 
-def calculate_validity_period(df: pd.DataFrame) -> pd.DataFrame:
-    """Calculate the average validity period and apply it to the DataFrame."""
-    temp_df = df.copy()
-    temp_df['validity_period_converted'] = pd.to_datetime(temp_df['validity_period'], format='%B %Y', errors='coerce')
-    temp_df['validity_delta'] = (temp_df['validity_period_converted'] - temp_df['creation_date']).dt.days
-    average_validity_days = temp_df['validity_delta'].dropna().mean()
+def validity_period_stats(df: pd.DataFrame) -> tuple:
+    """
+    Sum and count of the days between the creation date and the validity period of the rows where both are known.
+    """
+    validity_period_converted = pd.to_datetime(df['validity_period'], format='%B %Y', errors='coerce')
+    validity_delta = (validity_period_converted - df['creation_date']).dt.days.dropna()
+    return validity_delta.sum(), len(validity_delta)
+
+def apply_validity_period(df: pd.DataFrame, total_days: float, count: int) -> pd.DataFrame:
+    """Apply the average validity period computed from validity_period_stats to the DataFrame."""
+    average_validity_days = total_days / count if count else float('nan')
     average_validity_months = round(average_validity_days / 30)
     df['validity_period'] = df['creation_date'] + pd.DateOffset(months=average_validity_months)
     return df
 
+def calculate_validity_period(df: pd.DataFrame) -> pd.DataFrame:
+    """Calculate the average validity period and apply it to the DataFrame."""
+    return apply_validity_period(df, *validity_period_stats(df))
+
 def update_gas_values(df: pd.DataFrame) -> pd.DataFrame:
     """Update gas values based on conditions. sf6 has it's own column and divers values are mixed into the other_greenhouse_gas column"""
     df['sf6'] = df.apply(lambda row: row['additional_gaz_value_1'] if row['additional_gaz_1'] == 'sf6' else 0, axis=1)
@@ -178,16 +202,20 @@ def validate_data(df: pd.DataFrame):
     if not warnings_issued:
         logging.info("No validation warnings")
 
-def split_data(df: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame):
+def split_rows(df: pd.DataFrame) -> tuple:
     """
-    Splits the data into summary and detailed DataFrames, converting unique 'Poste' rows to 'Elément' where necessary.
+    Sorts the rows into the pieces the summary and detailed DataFrames are made of, see split_data.
+
+    Every piece keeps the index of the original DataFrame, except the new summary rows which are ordered by id.
 
     Args:
         df (pd.DataFrame): The original DataFrame.
 
     Returns:
-        summary_df (pd.DataFrame): DataFrame containing summary data.
-        detailed_df (pd.DataFrame): DataFrame containing detailed data.
+        element_rows (pd.DataFrame): 'Elément' rows.
+        unique_poste_rows (pd.DataFrame): 'Poste' rows with a unique id, converted to 'Elément'.
+        new_rows_summary (pd.DataFrame): 'Elément' rows created for the 'Poste' groups without one.
+        poste_rows (pd.DataFrame): The remaining 'Poste' rows.
     """
     # Columns to sum
     sum_columns = ['unaggregated_total', 'co2f', 'ch4f', 'ch4b', 'n2o', 'sf6', 'other_greenhouse_gas', 'co2b']
@@ -196,15 +224,12 @@ def split_data(df: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame):
     poste_rows = df[df['line_type'] == 'Poste']
     element_rows = df[df['line_type'] == 'Elément']
 
-    # Initialize summary dataframe
-    summary_df = element_rows.copy(deep=True)
-
-    # Identify rows in poste_rows with unique IDs, transform them and add them to the summary_df
+    # Identify rows in poste_rows with unique IDs and transform them
     unique_poste_rows = df[(df['line_type'] == 'Poste') & ~df['id'].duplicated(keep=False)]
     unique_poste_rows['line_type'] = 'Elément'
-    summary_df = pd.concat([summary_df, unique_poste_rows])
     poste_rows = poste_rows.drop(unique_poste_rows.index)
 
+    summary_df = pd.concat([element_rows, unique_poste_rows])
     data_types = {col: dtype for col, dtype in summary_df.dtypes.items()}
     new_rows_summary = pd.DataFrame(columns=df.columns).astype(data_types)
 
@@ -222,6 +247,18 @@ def split_data(df: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame):
             # Concatenate the new row to new_rows_summary
             new_rows_summary.loc[len(new_rows_summary)] = new_row
 
+    return element_rows, unique_poste_rows, new_rows_summary, poste_rows
+
+def combine_split_rows(element_rows: pd.DataFrame, unique_poste_rows: pd.DataFrame, new_rows_summary: pd.DataFrame, poste_rows: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame):
+    """
+    Builds the summary and detailed DataFrames from the pieces returned by split_rows.
+    """
+    # Initialize summary dataframe
+    summary_df = element_rows.copy(deep=True)
+    summary_df = pd.concat([summary_df, unique_poste_rows])
+
+    data_types = {col: dtype for col, dtype in summary_df.dtypes.items()}
+
     # Concatenate new_rows_summary with summary_df
     summary_df = pd.concat([summary_df, new_rows_summary], ignore_index=True).astype(data_types)
 
@@ -238,6 +275,19 @@ def split_data(df: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame):
 
     return summary_df, detailed_df
 
+def split_data(df: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame):
+    """
+    Splits the data into summary and detailed DataFrames, converting unique 'Poste' rows to 'Elément' where necessary.
+
+    Args:
+        df (pd.DataFrame): The original DataFrame.
+
+    Returns:
+        summary_df (pd.DataFrame): DataFrame containing summary data.
+        detailed_df (pd.DataFrame): DataFrame containing detailed data.
+    """
+    return combine_split_rows(*split_rows(df))
+
 def validate_split_dataframes(df_detailed: pd.DataFrame, df_summary: pd.DataFrame) -> bool:
     """
     Checks that every row in the summary DataFrame has a unique id and then validates that every 'id' in the detailed DataFrame corresponds to an 'id' in the summary DataFrame.
@@ -265,32 +315,22 @@ def validate_split_dataframes(df_detailed: pd.DataFrame, df_summary: pd.DataFram
         return False
 
 
-def process_and_load_data() -> None:
+def prepare_rows(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Main function to process and load data into the database.
+    Runs the cleaning steps that come before the validity period, which needs statistics over all rows.
     """
-
-    current_dir = Path(__file__).parent
-    data_path = current_dir.parent / "data" / "data.xlsx"
-
-    if data_already_loaded():
-        logging.info("Data is already loaded in the database.")
-        return
-
-    df = load_data(data_path)
-
-    logging.info("Processing data")
-
-    df = preprocess_data(df)
-
     df = handle_uncertainty(df)
 
     df = convert_date_language(df)
     df['creation_date'] = pd.to_datetime(df['creation_date'], format='%B %Y', errors='coerce')
     df['last_update_date'] = pd.to_datetime(df['last_update_date'], format='%B %Y', errors='coerce')
     df['last_update_date'] = df['last_update_date'].fillna(df['creation_date'])
-    df = calculate_validity_period(df)
+    return df
 
+def finish_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Runs the cleaning steps that come after the validity period.
+    """
     df = update_gas_values(df)
 
     df = handle_missing_data(df)
@@ -298,12 +338,162 @@ def process_and_load_data() -> None:
     df = convert_data_types(df)
 
     string_columns = ['attribute_name', 'other_name', 'tags', 'contributor', 'program', 'program_url', 'source', 'location', 'sub_location', 'comment', 'emission_type', 'emission_type_name']
-    df = convert_columns_to_string(df, string_columns)
+    return convert_columns_to_string(df, string_columns)
 
-    validate_data(df)
+def clean_data(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Runs every cleaning step on the preprocessed DataFrame.
+    """
+    df = prepare_rows(df)
+    df = calculate_validity_period(df)
+    return finish_rows(df)
 
-    summary_df, detailed_df = split_data(df)
-    validate_split_dataframes(detailed_df, summary_df)
+def partition_by_id(df: pd.DataFrame, partitions: int) -> list:
+    """
+    Splits a DataFrame by a hash of the 'id' column, so all the rows of an id end up in the same partition.
+    """
+    partition = pd.util.hash_pandas_object(df['id'], index=False) % partitions
+    return [df[partition == i] for i in range(partitions)]
+
+def prepare_partition(df: pd.DataFrame) -> tuple:
+    """
+    Map step run in a worker process: cleans a partition up to the validity period.
+
+    Returns:
+        df (pd.DataFrame): The partition.
+        stats (tuple): The validity period statistics of the partition.
+    """
+    df = prepare_rows(df)
+    return df, validity_period_stats(df)
+
+def finish_partition(df: pd.DataFrame, total_days: float, count: int) -> tuple:
+    """
+    Map step run in a worker process: applies the average validity period, finishes cleaning a partition and splits it.
+
+    Returns:
+        df (pd.DataFrame): The partition.
+        pieces (tuple): The pieces of the summary and detailed DataFrames, see split_rows.
+    """
+    df = apply_validity_period(df, total_days, count)
+    df = finish_rows(df)
+    return df, split_rows(df)
+
+def clean_data_parallel(df: pd.DataFrame, workers: int) -> tuple:
+    """
+    Cleans and splits the preprocessed DataFrame in a process pool, with the same result as clean_data and split_rows.
+
+    The rows are partitioned by id, the average validity period is reduced from the statistics
+    of each partition, and the results are put back in the original order.
+
+    Args:
+        df (pd.DataFrame): The preprocessed DataFrame.
+        workers (int): The number of worker processes, and of partitions.
+
+    Returns:
+        df (pd.DataFrame): The cleaned DataFrame.
+        pieces (tuple): The pieces of the summary and detailed DataFrames, see split_rows.
+    """
+    partitions = [partition for partition in partition_by_id(df, workers) if not partition.empty]
+    # Workers are spawned rather than forked so they don't inherit database connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        prepared = list(executor.map(prepare_partition, partitions))
+
+        total_days = sum(total for _, (total, _) in prepared)
+        count = sum(count for _, (_, count) in prepared)
+        partitions = [partition for partition, _ in prepared if not partition.empty]
+        finished = list(executor.map(finish_partition, partitions, repeat(total_days), repeat(count)))
+
+    # Each partition has its own categories, they are rebuilt from all the values
+    df = pd.concat([partition for partition, _ in finished]).sort_index()
+    categorical_columns = [
+        col for col in df.columns
+        if any(isinstance(partition[col].dtype, pd.CategoricalDtype) for partition, _ in finished)
+    ]
+    for col in categorical_columns:
+        df[col] = df[col].astype(object).astype('category')
+    data_types = {col: df[col].dtype for col in categorical_columns}
+
+    pieces = []
+    for position, piece in enumerate(zip(*(pieces for _, pieces in finished))):
+        piece = pd.concat(piece)
+        # New summary rows are ordered by id, the other pieces by their original position
+        piece = piece.sort_values('id', kind='stable') if position == 2 else piece.sort_index()
+        pieces.append(piece.astype(data_types))
+
+    return df, tuple(pieces)
+
+@contextmanager
+def run_stage(name: str, on_stage=None):
+    """
+    Times a stage of the ingestion and reports its progress. The stage is also profiled when
+    PROFILING_ENABLED and PROFILING_INGESTION are set.
+
+    Args:
+        name (str): The name of the stage, one of STAGES.
+        on_stage: Optional callback called with (name, status, rows, seconds) when the stage starts, succeeds or fails.
+
+    Yields:
+        dict: The stage, where the number of rows it produced is set under 'rows'.
+    """
+    stage = {'rows': None}
+    if on_stage:
+        on_stage(name, 'running', None, None)
+    profiler = profile('ingestion', name, PROFILING_MODE) if PROFILING_ENABLED and PROFILING_INGESTION else nullcontext()
+    start = time.perf_counter()
+    try:
+        with profiler:
+            yield stage
+    except Exception:
+        if on_stage:
+            on_stage(name, 'failed', stage['rows'], time.perf_counter() - start)
+        raise
+    seconds = time.perf_counter() - start
+    logging.info(f"Stage '{name}' done in {seconds:.2f}s, {stage['rows']} rows")
+    if on_stage:
+        on_stage(name, 'succeeded', stage['rows'], seconds)
+
+def ingest_file(data_path, on_stage=None, workers: int = TRANSFORM_WORKERS, on_loaded=None, force: bool = False) -> int:
+    """
+    Processes a workbook and loads the result into the database.
+
+    Args:
+        data_path: Path of the Excel file to load.
+        on_stage: Optional callback reporting the progress of each stage, see run_stage.
+        workers (int): The number of processes cleaning and splitting the data, 1 to do it in this process.
+        on_loaded: Optional callback called with the version once the data is committed, before the snapshot is built.
+        force (bool): Load the data even if it deletes a large share of the stored rows, see sync_data.
+
+    Returns:
+        int: The version of the ingestion run.
+    """
+    with run_stage('parse', on_stage) as stage:
+        df = load_data(data_path)
+        if df.empty:
+            raise ValueError(f"No data could be read from {data_path}")
+        df = preprocess_data(df)
+        stage['rows'] = len(df)
+
+    logging.info("Processing data")
+
+    # In parallel mode the partitions are also split by the workers, the split stage only puts them together
+    with run_stage('clean', on_stage) as stage:
+        if workers > 1:
+            df, pieces = clean_data_parallel(df, workers)
+        else:
+            df = clean_data(df)
+        stage['rows'] = len(df)
+
+    with run_stage('split', on_stage) as stage:
+        if workers > 1:
+            summary_df, detailed_df = combine_split_rows(*pieces)
+        else:
+            summary_df, detailed_df = split_data(df)
+        stage['rows'] = len(summary_df) + len(detailed_df)
+
+    with run_stage('validate', on_stage) as stage:
+        validate_data(df)
+        validate_split_dataframes(detailed_df, summary_df)
+        stage['rows'] = len(summary_df) + len(detailed_df)
 
     logging.info("Result data:")
 
@@ -312,10 +502,40 @@ def process_and_load_data() -> None:
 
     logging.info('Inserting data into postgresql database')
 
-    insert_summary_data(summary_df)
-    insert_detailed_data(detailed_df)
+    with run_stage('load', on_stage) as stage:
+        version = sync_data(summary_df, detailed_df, force)
+        stage['rows'] = len(summary_df) + len(detailed_df)
+
+    logging.info(f'Data successfully inserted, version {version}')
+    if on_loaded is not None:
+        on_loaded(version)
+
+    with run_stage('snapshot', on_stage) as stage:
+        build_snapshots(version)
+        stage['rows'] = len(summary_df) + len(detailed_df)
+
+    return version
+
+def process_and_load_data(force: bool = False) -> None:
+    """
+    Main function to process and load data into the database.
+
+    Args:
+        force (bool): Load the data even if the database already holds some. Only the rows
+            that changed since the last load are written.
+    """
+
+    current_dir = Path(__file__).parent
+    data_path = current_dir.parent / "data" / "data.xlsx"
+
+    if not force and data_already_loaded():
+        logging.info("Data is already loaded in the database.")
+        version = fetch_latest_version(primary=True)
+        if not snapshot_exists(version):
+            build_snapshots(version)
+        return
 
-    logging.info('Data successfully inserted')
+    ingest_file(data_path)
 
 if __name__ == "__main__":
-    process_and_load_data()
\ No newline at end of file
+    process_and_load_data(force=True)
@@ -0,0 +1,179 @@
+import datetime
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from pathlib import Path
+
+from myapp.db_operations import UNFINISHED_JOB_STATUSES, create_ingestion_job, fail_interrupted_ingestion_jobs, record_job_stage, touch_ingestion_jobs, update_ingestion_job
+from myapp.explore_data import ingest_file
+from myapp.profiling import add_profiles, drain_profiles
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+UPLOAD_DIR = Path(__file__).parent.parent / "data" / "uploads"
+INGESTION_WORKERS = int(os.environ.get("INGESTION_WORKERS", "1"))
+# Uploads replace the stored data, so they are disabled unless configured
+INGESTION_UPLOADS_ENABLED = os.environ.get("INGESTION_UPLOADS_ENABLED", "false").lower() in ("1", "true", "yes")
+INGESTION_TOKEN = os.environ.get("INGESTION_TOKEN")
+# Seconds between the heartbeats of the jobs of this process, a job missing 3 of them is failed
+INGESTION_HEARTBEAT_SECONDS = float(os.environ.get("INGESTION_HEARTBEAT_SECONDS", "10"))
+
+_executor = None
+# Unfinished jobs submitted by this process
+_active_jobs = set()
+_heartbeat_stop = threading.Event()
+_heartbeat_thread = None
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Returns the process pool running the ingestion jobs, starting it on first use.
+    """
+    global _executor
+    if _executor is None:
+        # Workers are spawned rather than forked so they don't inherit the database connections of the API process
+        _executor = ProcessPoolExecutor(max_workers=INGESTION_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+def shutdown_executor() -> None:
+    """
+    Stops the process pool, waiting for the running jobs to finish.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+def heartbeat() -> None:
+    """
+    Refreshes the heartbeat of the jobs of this process and fails the jobs of processes that stopped.
+    """
+    try:
+        if _active_jobs:
+            touch_ingestion_jobs(list(_active_jobs))
+        fail_interrupted_ingestion_jobs(datetime.datetime.utcnow() - datetime.timedelta(seconds=3 * INGESTION_HEARTBEAT_SECONDS))
+    except Exception as e:
+        logging.error(f"Error refreshing ingestion job heartbeats: {e}")
+
+def start_heartbeat() -> None:
+    """
+    Starts the background thread sending heartbeats, see heartbeat.
+    """
+    global _heartbeat_thread
+    if _heartbeat_thread is not None:
+        return
+
+    def run():
+        heartbeat()
+        while not _heartbeat_stop.wait(INGESTION_HEARTBEAT_SECONDS):
+            heartbeat()
+
+    _heartbeat_stop.clear()
+    _heartbeat_thread = threading.Thread(target=run, daemon=True)
+    _heartbeat_thread.start()
+
+def stop_heartbeat() -> None:
+    """
+    Stops the heartbeat thread.
+    """
+    global _heartbeat_thread
+    if _heartbeat_thread is not None:
+        _heartbeat_stop.set()
+        _heartbeat_thread.join()
+        _heartbeat_thread = None
+
+def submit_to_pool(fn, *args) -> Future:
+    """
+    Submits a call to the process pool, replacing the pool if one of its workers died.
+    """
+    global _executor
+    try:
+        return get_executor().submit(fn, *args)
+    except BrokenProcessPool:
+        logging.warning("Ingestion process pool is broken, starting a new one")
+        _executor = None
+        return get_executor().submit(fn, *args)
+
+def run_ingestion_job(job_id: int, path: str, force: bool = False) -> list:
+    """
+    Processes an uploaded workbook, recording the progress of each stage. Runs in a worker process.
+
+    Args:
+        job_id (int): The id of the job.
+        path (str): The path of the uploaded file, deleted once the job is over.
+        force (bool): Load the workbook even if it deletes a large share of the stored rows.
+
+    Returns:
+        list: The profiles of the stages, if ingestion profiling is enabled.
+    """
+    if not update_ingestion_job(job_id, from_status=['queued'], status='running', started_at=datetime.datetime.utcnow()):
+        logging.warning(f"Ingestion job {job_id} is no longer queued, skipping it")
+        Path(path).unlink(missing_ok=True)
+        return []
+
+    def on_stage(name, status, rows, seconds):
+        record_job_stage(job_id, name, status, rows, seconds)
+
+    # Recorded as soon as the data is committed, so it is kept if the snapshot stage fails
+    def on_loaded(version):
+        update_ingestion_job(job_id, version=version)
+
+    try:
+        version = ingest_file(path, on_stage, on_loaded=on_loaded, force=force)
+    except Exception as e:
+        logging.error(f"Ingestion job {job_id} failed: {e}")
+        update_ingestion_job(job_id, from_status=['running'], status='failed', finished_at=datetime.datetime.utcnow(), error=str(e))
+    else:
+        # A job failed as interrupted in the meantime keeps that status
+        update_ingestion_job(job_id, from_status=['running'], status='succeeded', finished_at=datetime.datetime.utcnow(), version=version)
+    finally:
+        Path(path).unlink(missing_ok=True)
+    return drain_profiles()
+
+def on_job_done(job_id: int, future: Future) -> None:
+    """
+    Marks a job as failed if its worker process died before it could report it, and keeps the
+    profiles of its stages in the API process.
+    """
+    _active_jobs.discard(job_id)
+    if future.cancelled():
+        update_ingestion_job(job_id, from_status=UNFINISHED_JOB_STATUSES, status='cancelled', finished_at=datetime.datetime.utcnow())
+    elif future.exception() is not None:
+        logging.error(f"Ingestion job {job_id} worker failed: {future.exception()}")
+        update_ingestion_job(job_id, from_status=UNFINISHED_JOB_STATUSES, status='failed', finished_at=datetime.datetime.utcnow(), error=str(future.exception()))
+    else:
+        add_profiles(future.result())
+
+def submit_ingestion_job(file, filename: str, force: bool = False) -> int:
+    """
+    Saves an uploaded workbook and queues its ingestion in the process pool.
+
+    Args:
+        file: The uploaded file object.
+        filename (str): The name of the uploaded file.
+        force (bool): Load the workbook even if it deletes a large share of the stored rows.
+
+    Returns:
+        int: The id of the job.
+    """
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    job_id = create_ingestion_job(filename)
+    _active_jobs.add(job_id)
+    path = UPLOAD_DIR / f"{job_id}{Path(filename).suffix}"
+    with open(path, 'wb') as upload:
+        shutil.copyfileobj(file, upload)
+
+    try:
+        future = submit_to_pool(run_ingestion_job, job_id, str(path), force)
+    except Exception as e:
+        _active_jobs.discard(job_id)
+        update_ingestion_job(job_id, status='failed', finished_at=datetime.datetime.utcnow(), error=str(e))
+        path.unlink(missing_ok=True)
+        raise
+    future.add_done_callback(partial(on_job_done, job_id))
+    logging.info(f"Queued ingestion job {job_id} for {filename}")
+    return job_id
@@ -1,9 +1,14 @@
 import logging
-from typing import List
-from fastapi import FastAPI, HTTPException
+from typing import List, Optional
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response, UploadFile
+from pydantic_core import to_json
 from myapp.database import create_db_and_tables
-from myapp.db_operations import fetch_all_summary_data, fetch_detailed_data_by_summary_id, fetch_one_detailed_data, fetch_one_summary_data, fetch_summary_data_by_filter
-from myapp.pydantic_models import DetailedDataModel, SummaryDataModel
+from myapp.db_operations import fetch_all_summary_data, fetch_changes, fetch_detailed_data_by_summary_id, fetch_ingestion_job, fetch_ingestion_jobs, fetch_one_detailed_data, fetch_one_summary_data, fetch_summary_data_by_filter, parse_fields
+from myapp.emissions import calculate_batch_emissions
+from myapp.ingestion_jobs import INGESTION_TOKEN, INGESTION_UPLOADS_ENABLED, shutdown_executor, start_heartbeat, stop_heartbeat, submit_ingestion_job
+from myapp.snapshots import detailed_snapshot_response, summary_snapshot_response
+from myapp.profiling import PROFILING_ENABLED, PROFILING_TOKEN, export_pstats, export_speedscope, get_profile, list_profiles, profile, requested_profile_mode
+from myapp.pydantic_models import ChangesModel, DetailedDataModel, EmissionsBatchModel, EmissionsBatchResultModel, IngestionJobModel, PartialDetailedDataModel, PartialSummaryDataModel, ProfileModel, SummaryDataModel
 from myapp.explore_data import process_and_load_data
 
 create_db_and_tables()
@@ -11,10 +16,43 @@ process_and_load_data()
 
 app = FastAPI()
 
-@app.get("/summary-data/{id}", response_model=SummaryDataModel)
-async def get_one_summary_data(id: int):
+@app.on_event("startup")
+def start_ingestion_heartbeat():
+    start_heartbeat()
+
+@app.on_event("shutdown")
+def stop_ingestion_workers():
+    shutdown_executor()
+    stop_heartbeat()
+
+async def profile_requests(request: Request, call_next):
+    mode = requested_profile_mode(request.headers)
+    if mode is None:
+        return await call_next(request)
+    with profile('request', f"{request.method} {request.url.path}", mode) as record:
+        response = await call_next(request)
+    if record is not None:
+        response.headers["X-Profile-Id"] = str(record['id'])
+    return response
+
+# The middleware is only added when profiling is enabled, so it costs nothing otherwise
+if PROFILING_ENABLED:
+    app.middleware("http")(profile_requests)
+
+# Description of the fields query parameter of the read routes
+FIELDS_QUERY = Query(None, description="Comma separated list of the fields to return, all fields when omitted")
+
+def get_fields(fields: Optional[str], *data_models) -> Optional[list]:
+    try:
+        return parse_fields(fields, *data_models)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@app.get("/summary-data/{id}", response_model=PartialSummaryDataModel, response_model_exclude_unset=True)
+async def get_one_summary_data(id: int, fields: Optional[str] = FIELDS_QUERY):
+    selected_fields = get_fields(fields, SummaryDataModel)
     try:
-        data = fetch_one_summary_data(id)
+        data = fetch_one_summary_data(id, selected_fields)
         if data is None:
             raise HTTPException(status_code=404, detail="Item not found")
         return data
@@ -22,10 +60,15 @@ async def get_one_summary_data(id: int):
         logging.error(f"Error fetching data: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/summary-data", response_model=list[SummaryDataModel])
-async def get_all_summary_data():
+@app.get("/summary-data", response_model=list[PartialSummaryDataModel], response_model_exclude_unset=True)
+async def get_all_summary_data(request: Request, fields: Optional[str] = FIELDS_QUERY):
+    if fields is None:
+        response = summary_snapshot_response(request.headers.get("accept-encoding"), request.headers.get("if-none-match"))
+        if response is not None:
+            return response
+    selected_fields = get_fields(fields, SummaryDataModel)
     try:
-        data = fetch_all_summary_data()
+        data = fetch_all_summary_data(selected_fields)
         if data is None:
             raise HTTPException(status_code=404, detail="Table is empty")
         return data
@@ -34,10 +77,15 @@ async def get_all_summary_data():
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/detailed-data/by-summary/{summary_id}", response_model=List[DetailedDataModel])
-async def get_detailed_data_by_summary_id(summary_id: int):
+@app.get("/detailed-data/by-summary/{summary_id}", response_model=List[PartialDetailedDataModel], response_model_exclude_unset=True)
+async def get_detailed_data_by_summary_id(request: Request, summary_id: int, fields: Optional[str] = FIELDS_QUERY):
+    if fields is None:
+        response = detailed_snapshot_response(summary_id, request.headers.get("accept-encoding"), request.headers.get("if-none-match"))
+        if response is not None:
+            return response
+    selected_fields = get_fields(fields, DetailedDataModel)
     try:
-        data = fetch_detailed_data_by_summary_id(summary_id)
+        data = fetch_detailed_data_by_summary_id(summary_id, selected_fields)
         if data == [] or None:
             raise HTTPException(status_code=404, detail="No linked data")
         return data
@@ -45,10 +93,11 @@ async def get_detailed_data_by_summary_id(summary_id: int):
         logging.error(f"Error fetching data: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/detailed-data/{id}", response_model=DetailedDataModel)
-async def get_one_detailed_data(id: int):
+@app.get("/detailed-data/{id}", response_model=PartialDetailedDataModel, response_model_exclude_unset=True)
+async def get_one_detailed_data(id: int, fields: Optional[str] = FIELDS_QUERY):
+    selected_fields = get_fields(fields, DetailedDataModel)
     try:
-        data = fetch_one_detailed_data(id)
+        data = fetch_one_detailed_data(id, selected_fields)
         if data is None:
             raise HTTPException(status_code=404, detail="Item not found")
         return data
@@ -56,10 +105,11 @@ async def get_one_detailed_data(id: int):
         logging.error(f"Error fetching data: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/summary-data/filter", response_model=List[SummaryDataModel])
-async def filter_summary_data(column_name: str, filter_value: str):
+@app.get("/summary-data/filter", response_model=List[PartialSummaryDataModel], response_model_exclude_unset=True)
+async def filter_summary_data(column_name: str, filter_value: str, fields: Optional[str] = FIELDS_QUERY):
+    selected_fields = get_fields(fields, SummaryDataModel)
     try:
-        data = fetch_summary_data_by_filter(column_name, filter_value)
+        data = fetch_summary_data_by_filter(column_name, filter_value, selected_fields)
         if not data:
             raise HTTPException(status_code=404, detail=f"No data found for column '{column_name}' with value '{filter_value}'")
         return data
@@ -67,4 +117,100 @@ async def filter_summary_data(column_name: str, filter_value: str):
         logging.error(f"Error fetching data by column: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/emissions/calculate", response_model=EmissionsBatchResultModel)
+async def calculate_emissions_batch(batch: EmissionsBatchModel):
+    try:
+        data = calculate_batch_emissions(batch)
+        # The results are built from plain floats, so they are encoded directly instead of being re-validated
+        return Response(content=to_json(data), media_type="application/json")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logging.error(f"Error calculating emissions: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/changes", response_model=ChangesModel, response_model_exclude_unset=True)
+async def get_changes(
+    since: int = Query(0, ge=0, description="Version of the last sync, 0 to fetch everything"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    limit: int = Query(1000, ge=1, le=10000),
+    fields: Optional[str] = FIELDS_QUERY
+):
+    selected_fields = get_fields(fields, SummaryDataModel, DetailedDataModel)
+    try:
+        return fetch_changes(since, cursor, limit, selected_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        logging.error(f"Error fetching changes: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
+def check_ingestion_access(token: Optional[str]) -> None:
+    if not INGESTION_UPLOADS_ENABLED:
+        raise HTTPException(status_code=404, detail="Ingestion uploads are disabled")
+    if INGESTION_TOKEN is not None and token != INGESTION_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid ingestion token")
+
+@app.post("/ingestion-jobs", response_model=IngestionJobModel, status_code=202)
+async def upload_ingestion_file(
+    file: UploadFile,
+    force: bool = Query(False, description="Load the workbook even if it deletes a large share of the stored rows"),
+    x_ingestion_token: Optional[str] = Header(None)
+):
+    check_ingestion_access(x_ingestion_token)
+    try:
+        job_id = submit_ingestion_job(file.file, file.filename, force)
+        return fetch_ingestion_job(job_id)
+    except Exception as e:
+        logging.error(f"Error submitting ingestion job: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/ingestion-jobs", response_model=List[IngestionJobModel])
+async def get_ingestion_jobs(limit: int = Query(20, ge=1, le=100), x_ingestion_token: Optional[str] = Header(None)):
+    check_ingestion_access(x_ingestion_token)
+    try:
+        return fetch_ingestion_jobs(limit)
+    except Exception as e:
+        logging.error(f"Error fetching ingestion jobs: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/ingestion-jobs/{job_id}", response_model=IngestionJobModel)
+async def get_ingestion_job(job_id: int, x_ingestion_token: Optional[str] = Header(None)):
+    check_ingestion_access(x_ingestion_token)
+    job = fetch_ingestion_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+def check_profiling_access(token: Optional[str]) -> None:
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    if PROFILING_TOKEN is not None and token != PROFILING_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid profiling token")
+
+@app.get("/admin/profiles", response_model=List[ProfileModel])
+async def get_profiles(x_profile_token: Optional[str] = Header(None)):
+    check_profiling_access(x_profile_token)
+    return list_profiles()
+
+@app.get("/admin/profiles/{profile_id}")
+async def download_profile(
+    profile_id: int,
+    format: str = Query("pstats", pattern="^(pstats|speedscope)$", description="pstats for cprofile profiles, speedscope for sampling profiles"),
+    x_profile_token: Optional[str] = Header(None)
+):
+    check_profiling_access(x_profile_token)
+    record = get_profile(profile_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    try:
+        if format == "pstats":
+            content, media_type, extension = export_pstats(record), "application/octet-stream", "prof"
+        else:
+            content, media_type, extension = to_json(export_speedscope(record)), "application/json", "speedscope.json"
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    headers = {"Content-Disposition": f'attachment; filename="profile-{profile_id}.{extension}"'}
+    return Response(content=content, media_type=media_type, headers=headers)
@@ -42,6 +42,9 @@ class SummaryData(SQLModel, table=True):
     other_greenhouse_gas: float
     co2b: float
     sf6: int
+    version: int = Field(default=0, index=True)
+    updated_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
+    content_hash: Optional[str] = None
 
 class DetailedData(SQLModel, table=True):
     id: int = Field(default=None, primary_key=True)
@@ -77,4 +80,43 @@ class DetailedData(SQLModel, table=True):
     n2o: float
     other_greenhouse_gas: float
     co2b: float
-    sf6: int
\ No newline at end of file
+    sf6: int
+    version: int = Field(default=0, index=True)
+    updated_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
+    content_hash: Optional[str] = None
+
+class IngestionRun(SQLModel, table=True):
+    id: int = Field(default=None, primary_key=True)
+    created_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+
+class DeletedRecord(SQLModel, table=True):
+    id: int = Field(default=None, primary_key=True)
+    table_name: str = Field(index=True)
+    record_id: int = Field(index=True)
+    summary_id: Optional[int]
+    version: int = Field(index=True)
+    deleted_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
+
+class IngestionJob(SQLModel, table=True):
+    id: int = Field(default=None, primary_key=True)
+    filename: str
+    status: str = Field(default='queued', index=True)
+    created_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
+    started_at: Optional[datetime.datetime] = None
+    finished_at: Optional[datetime.datetime] = None
+    version: Optional[int] = Field(default=None, foreign_key="ingestionrun.id")
+    error: Optional[str] = None
+    # Refreshed by the API process owning the job while it is queued or running
+    heartbeat_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow, index=True)
+
+class IngestionJobStage(SQLModel, table=True):
+    id: int = Field(default=None, primary_key=True)
+    job_id: int = Field(foreign_key="ingestionjob.id", index=True)
+    name: str
+    status: str
+    rows: Optional[int] = None
+    seconds: Optional[float] = None
+    started_at: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
@@ -0,0 +1,229 @@
+import cProfile
+import datetime
+import itertools
+import logging
+import marshal
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+# 'cprofile' records every call and is downloadable as pstats, 'sampling' records the stack at
+# regular intervals and is downloadable as speedscope JSON
+PROFILING_MODE = os.environ.get("PROFILING_MODE", "cprofile")
+PROFILING_SAMPLE_RATE = float(os.environ.get("PROFILING_SAMPLE_RATE", "0"))
+PROFILING_SAMPLING_INTERVAL = float(os.environ.get("PROFILING_SAMPLING_INTERVAL", "0.001"))
+PROFILING_BUFFER_SIZE = int(os.environ.get("PROFILING_BUFFER_SIZE", "20"))
+PROFILING_INGESTION = os.environ.get("PROFILING_INGESTION", "false").lower() in ("1", "true", "yes")
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN")
+
+PROFILE_MODES = ['cprofile', 'sampling']
+PROFILE_HEADER = "X-Profile"
+PROFILE_TOKEN_HEADER = "X-Profile-Token"
+
+# Last profiles captured in this process, oldest first
+_profiles = deque(maxlen=PROFILING_BUFFER_SIZE)
+_profile_ids = itertools.count(1)
+# Only one profiler can run at a time
+_profiler_lock = threading.Lock()
+
+class StackSampler:
+    """
+    Statistical profiler recording the stack of a thread at regular intervals from a background thread.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            # Samples are weighted by the time since the previous one, as the GIL can delay them
+            self.samples.append((tuple(reversed(stack)), now - last))
+            last = now
+
+    # Same interface as cProfile.Profile
+    def enable(self) -> None:
+        self._thread.start()
+
+    def disable(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+def requested_profile_mode(headers) -> str:
+    """
+    Decides whether a request is profiled, from its headers and the sampling rate.
+
+    Returns:
+        str: The profile mode to use, None if the request isn't profiled.
+    """
+    if not PROFILING_ENABLED:
+        return None
+    mode = headers.get(PROFILE_HEADER)
+    if mode is not None:
+        if PROFILING_TOKEN is not None and headers.get(PROFILE_TOKEN_HEADER) != PROFILING_TOKEN:
+            return None
+        return mode if mode in PROFILE_MODES else PROFILING_MODE
+    if PROFILING_SAMPLE_RATE > 0 and random.random() < PROFILING_SAMPLE_RATE:
+        return PROFILING_MODE
+    return None
+
+def store_profile(kind: str, name: str, mode: str, seconds: float, data, created_at: datetime.datetime = None) -> int:
+    """
+    Adds a profile to the ring buffer, dropping the oldest one when it is full.
+
+    Args:
+        kind (str): What was profiled, 'request' or 'ingestion'.
+        name (str): The request or ingestion stage that was profiled.
+        mode (str): The profile mode, one of PROFILE_MODES.
+        seconds (float): The wall time of the profiled code.
+        data: pstats data for 'cprofile' profiles, (stack, weight) samples for 'sampling' profiles.
+        created_at (datetime.datetime): When the profile started, now if not given.
+
+    Returns:
+        int: The id of the profile.
+    """
+    id = next(_profile_ids)
+    _profiles.append({
+        'id': id,
+        'kind': kind,
+        'name': name,
+        'mode': mode,
+        'created_at': created_at or datetime.datetime.utcnow(),
+        'seconds': seconds,
+        'data': data
+    })
+    return id
+
+@contextmanager
+def profile(kind: str, name: str, mode: str):
+    """
+    Profiles the code run in the block and stores the result in the ring buffer.
+
+    The profile is skipped if another one is already running. Other requests handled by the
+    event loop while the block awaits show up in the profile too.
+
+    Yields:
+        dict: The profile, where its 'id' is set at the end of the block, None if it is skipped.
+    """
+    if not _profiler_lock.acquire(blocking=False):
+        yield None
+        return
+
+    try:
+        record = {'id': None}
+        created_at = datetime.datetime.utcnow()
+        if mode == 'sampling':
+            profiler = StackSampler(threading.get_ident(), PROFILING_SAMPLING_INTERVAL)
+        else:
+            profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield record
+        finally:
+            profiler.disable()
+            seconds = time.perf_counter() - start
+            if mode == 'sampling':
+                data = profiler.samples
+            else:
+                profiler.create_stats()
+                data = profiler.stats
+            record['id'] = store_profile(kind, name, mode, seconds, data, created_at)
+            logging.info(f"Profiled {kind} '{name}' in {seconds:.3f}s, profile {record['id']}")
+    finally:
+        _profiler_lock.release()
+
+def drain_profiles() -> list:
+    """
+    Removes and returns the profiles of this process, used to send them from a worker process to the API.
+    """
+    profiles = list(_profiles)
+    _profiles.clear()
+    return profiles
+
+def add_profiles(profiles: list) -> None:
+    """
+    Adds profiles captured by another process to the ring buffer, giving them new ids.
+    """
+    for record in profiles:
+        store_profile(record['kind'], record['name'], record['mode'], record['seconds'], record['data'], record['created_at'])
+
+def list_profiles() -> list:
+    """
+    Lists the profiles of the ring buffer, newest first, without their data.
+    """
+    return [{key: value for key, value in record.items() if key != 'data'} for record in reversed(_profiles)]
+
+def get_profile(id: int) -> dict:
+    """
+    Returns a profile of the ring buffer, None if it isn't there anymore.
+    """
+    return next((record for record in _profiles if record['id'] == id), None)
+
+def export_pstats(record: dict) -> bytes:
+    """
+    Encodes a cProfile profile in the format written by pstats.Stats.dump_stats.
+
+    Raises:
+        ValueError: If the profile wasn't captured with cProfile.
+    """
+    if record['mode'] != 'cprofile':
+        raise ValueError(f"Profile {record['id']} was captured in {record['mode']} mode, download it as speedscope")
+    return marshal.dumps(record['data'])
+
+def export_speedscope(record: dict) -> dict:
+    """
+    Converts a sampling profile to the speedscope file format.
+
+    Raises:
+        ValueError: If the profile wasn't captured in sampling mode.
+    """
+    if record['mode'] != 'sampling':
+        raise ValueError(f"Profile {record['id']} was captured in {record['mode']} mode, download it as pstats")
+
+    frames = {}
+    samples = []
+    weights = []
+    for stack, weight in record['data']:
+        samples.append([frames.setdefault(frame, len(frames)) for frame in stack])
+        weights.append(weight)
+
+    name = f"{record['kind']} {record['name']}"
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'ecoact',
+        'activeProfileIndex': 0,
+        'shared': {
+            'frames': [{'name': function, 'file': file, 'line': line} for function, file, line in frames]
+        },
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': samples,
+            'weights': weights
+        }]
+    }
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, ConfigDict, validator
-from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field, create_model, validator
+from typing import Annotated, List, Optional
 from datetime import datetime
 import math
 
@@ -45,6 +45,8 @@ class SummaryDataModel(BaseModel):
     other_greenhouse_gas: float
     co2b: float
     sf6: int
+    version: int
+    updated_at: datetime
 
     @validator('*', pre=True, allow_reuse=True)
     def handle_non_compliant_values(cls, v):
@@ -90,9 +92,109 @@ class DetailedDataModel(BaseModel):
     other_greenhouse_gas: float
     co2b: float
     sf6: int
+    version: int
+    updated_at: datetime
 
     @validator('*', pre=True, allow_reuse=True)
     def handle_non_compliant_values(cls, v):
         if isinstance(v, float) and (math.isnan(v) or math.isinf(v)):
             return None  # Replace non-compliant values with None
-        return v
\ No newline at end of file
+        return v
+
+def partial_model(model):
+    """
+    Builds a copy of a model where every field is optional, for responses restricted to some fields.
+    """
+    fields = {name: (Optional[field.annotation], None) for name, field in model.model_fields.items()}
+    return create_model(f"Partial{model.__name__}", __base__=model, **fields)
+
+PartialSummaryDataModel = partial_model(SummaryDataModel)
+PartialDetailedDataModel = partial_model(DetailedDataModel)
+
+# Ids are matched against int64 arrays
+EmissionsId = Annotated[int, Field(ge=0, lt=2**63)]
+
+class EmissionsBatchModel(BaseModel):
+    # One entry per line in every list, a line refers to exactly one of its summary or detailed id
+    quantities: List[float] = Field(min_length=1)
+    summary_ids: Optional[List[Optional[EmissionsId]]] = None
+    detailed_ids: Optional[List[Optional[EmissionsId]]] = None
+    groups: Optional[List[Optional[str]]] = None
+
+class EmissionsResultModel(BaseModel):
+    co2f: float
+    ch4f: float
+    ch4b: float
+    n2o: float
+    co2b: float
+    sf6: float
+    other_greenhouse_gas: float
+    total: float
+    uncertainty: Optional[float]
+
+class EmissionsGroupModel(EmissionsResultModel):
+    group: str
+
+class EmissionsLinesModel(BaseModel):
+    # One entry per line, in input order
+    co2f: List[float]
+    ch4f: List[float]
+    ch4b: List[float]
+    n2o: List[float]
+    co2b: List[float]
+    sf6: List[float]
+    other_greenhouse_gas: List[float]
+    total: List[float]
+    uncertainty: List[Optional[float]]
+
+class EmissionsBatchResultModel(BaseModel):
+    lines: EmissionsLinesModel
+    totals: EmissionsResultModel
+    groups: Optional[List[EmissionsGroupModel]] = None
+
+class SummaryChangesModel(BaseModel):
+    upserted: List[PartialSummaryDataModel]
+    deleted: List[int]
+
+class DetailedChangesModel(BaseModel):
+    upserted: List[PartialDetailedDataModel]
+    deleted: List[int]
+
+class ChangesModel(BaseModel):
+    version: int
+    summary: SummaryChangesModel
+    detailed: DetailedChangesModel
+    next_cursor: Optional[str]
+
+class IngestionJobStageModel(BaseModel):
+    model_config = ConfigDict(from_attributes = True)
+
+    name: str
+    status: str
+    rows: Optional[int]
+    seconds: Optional[float]
+    started_at: datetime
+
+class IngestionJobModel(BaseModel):
+    model_config = ConfigDict(from_attributes = True)
+
+    id: int
+    filename: str
+    status: str
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+    version: Optional[int]
+    error: Optional[str]
+    stages: List[IngestionJobStageModel] = []
+    inserted: Optional[int] = None
+    updated: Optional[int] = None
+    deleted: Optional[int] = None
+
+class ProfileModel(BaseModel):
+    id: int
+    kind: str
+    name: str
+    mode: str
+    created_at: datetime
+    seconds: float
@@ -0,0 +1,287 @@
+import fcntl
+import gzip
+import json
+import logging
+import mmap
+import os
+import shutil
+from contextlib import contextmanager
+from itertools import groupby
+from pathlib import Path
+from typing import List
+
+from fastapi import Response
+from fastapi.responses import FileResponse
+from pydantic import TypeAdapter
+
+from myapp.db_operations import fetch_snapshot_data
+from myapp.pydantic_models import DetailedDataModel, SummaryDataModel
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SNAPSHOT_DIR = Path(__file__).parent.parent / "data" / "snapshots"
+# File holding the version of the snapshot to serve
+CURRENT_FILE = SNAPSHOT_DIR / "current"
+# Number of snapshot versions kept on disk, older ones may still be read by other workers
+KEEP_SNAPSHOTS = 2
+
+# Encodings in order of preference, with the extension of their files
+ENCODINGS = {'br': '.br', 'gzip': '.gz', 'identity': ''}
+
+summary_adapter = TypeAdapter(List[SummaryDataModel])
+detailed_adapter = TypeAdapter(List[DetailedDataModel])
+
+# Snapshot being served by this process
+_snapshot = {'version': None}
+
+def available_encodings() -> list:
+    """
+    Lists the encodings snapshots are written in, brotli being optional.
+    """
+    return [encoding for encoding in ENCODINGS if encoding != 'br' or brotli is not None]
+
+def encode(content: bytes, encoding: str) -> bytes:
+    """
+    Compresses bytes with a content encoding.
+    """
+    if encoding == 'br':
+        # Quality 11 is an order of magnitude slower for a few percent smaller files
+        return brotli.compress(content, quality=9)
+    if encoding == 'gzip':
+        return gzip.compress(content, compresslevel=9)
+    return content
+
+def negotiate_encoding(accept_encoding: str, encodings: list) -> str:
+    """
+    Picks the preferred encoding accepted by a client from its Accept-Encoding header.
+
+    Args:
+        accept_encoding (str): The Accept-Encoding header of the request.
+        encodings (list): The encodings the content is available in.
+    """
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in ENCODINGS:
+        if encoding == 'identity':
+            break
+        if encoding in encodings and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return 'identity'
+
+def build_snapshots(version: int) -> None:
+    """
+    Writes the full summary table and the detailed rows of each summary id as ready to send
+    JSON, in every available encoding, then makes them the snapshot to serve.
+
+    The detailed lists of all summary ids are concatenated in one file per encoding, with an
+    index of the offset and length of each list.
+
+    The data is read at the latest version, which may be newer than the one given if another
+    run was loaded in the meantime, and the snapshot served only ever moves to newer versions.
+    If the snapshot can't be built, no snapshot is served until one is.
+
+    Args:
+        version (int): The version of the data in the database.
+    """
+    logging.info(f"Building snapshots for version {version}...")
+    try:
+        write_snapshots()
+    except Exception:
+        # The version is loaded already, the routes fall back to the database rather than serving an older snapshot
+        with current_lock():
+            if read_current_version() < version:
+                CURRENT_FILE.unlink(missing_ok=True)
+        raise
+
+@contextmanager
+def current_lock():
+    """
+    Locks the current snapshot file against the other processes building snapshots.
+    """
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    with open(SNAPSHOT_DIR / "current.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def read_current_version() -> int:
+    """
+    Returns the version of the snapshot being served, 0 if there is none.
+    """
+    try:
+        return int(CURRENT_FILE.read_text())
+    except (OSError, ValueError):
+        return 0
+
+def write_snapshots() -> None:
+    """
+    Writes the snapshot files of the latest version and makes it the snapshot to serve, see build_snapshots.
+    """
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    build_dir = SNAPSHOT_DIR / f"build.{os.getpid()}.tmp"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    build_dir.mkdir()
+
+    try:
+        version, summary_records, detailed_records = fetch_snapshot_data()
+        target = SNAPSHOT_DIR / str(version)
+
+        summary = summary_adapter.dump_json(summary_records)
+        for encoding in available_encodings():
+            (build_dir / f"summary.json{ENCODINGS[encoding]}").write_bytes(encode(summary, encoding))
+
+        index = {}
+        files = {encoding: open(build_dir / f"detailed.json{ENCODINGS[encoding]}", 'wb') for encoding in available_encodings()}
+        try:
+            for summary_id, group in groupby(detailed_records, key=lambda record: record.summary_id):
+                content = detailed_adapter.dump_json(list(group))
+                index[summary_id] = {}
+                for encoding, file in files.items():
+                    encoded = encode(content, encoding)
+                    index[summary_id][encoding] = [file.tell(), len(encoded)]
+                    file.write(encoded)
+        finally:
+            for file in files.values():
+                file.close()
+        (build_dir / "detailed.index.json").write_text(json.dumps(index))
+
+        try:
+            os.rename(build_dir, target)
+        except OSError:
+            # Another process already built this version
+            shutil.rmtree(build_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+
+    with current_lock():
+        current = read_current_version()
+        if version <= current:
+            logging.info(f"Snapshot {current} is already served, not switching back to {version}")
+            return
+        current_tmp = SNAPSHOT_DIR / f"current.{os.getpid()}.tmp"
+        current_tmp.write_text(str(version))
+        os.replace(current_tmp, CURRENT_FILE)
+
+    for old in sorted((path for path in SNAPSHOT_DIR.iterdir() if path.name.isdigit()), key=lambda path: int(path.name))[:-KEEP_SNAPSHOTS]:
+        shutil.rmtree(old, ignore_errors=True)
+    logging.info(f"Snapshots for version {version} written to {target}")
+
+def snapshot_exists(version: int) -> bool:
+    """
+    Checks if the snapshot of a version is the one being served.
+    """
+    try:
+        return CURRENT_FILE.read_text() == str(version) and (SNAPSHOT_DIR / str(version)).is_dir()
+    except OSError:
+        return False
+
+def current_snapshot() -> dict:
+    """
+    Returns the snapshot to serve, loading its detailed index and files when a new one was built.
+
+    Returns:
+        dict: The version, directory, detailed index and memory mapped detailed files, None if there is no snapshot.
+    """
+    try:
+        version = CURRENT_FILE.read_text()
+    except OSError:
+        return None
+    if _snapshot['version'] == version:
+        return _snapshot
+
+    directory = SNAPSHOT_DIR / version
+    try:
+        index = {int(summary_id): offsets for summary_id, offsets in json.loads((directory / "detailed.index.json").read_text()).items()}
+        detailed = {}
+        # Only the encodings available when the snapshot was built
+        encodings = [encoding for encoding in ENCODINGS if (directory / f"summary.json{ENCODINGS[encoding]}").exists()]
+        for encoding in encodings:
+            with open(directory / f"detailed.json{ENCODINGS[encoding]}", 'rb') as file:
+                # Empty files can't be mapped, they also have nothing to serve
+                detailed[encoding] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size else b''
+    except (OSError, ValueError) as e:
+        logging.error(f"Error loading snapshot {version}: {e}")
+        return None
+
+    for previous in _snapshot.get('detailed', {}).values():
+        if isinstance(previous, mmap.mmap):
+            previous.close()
+    _snapshot.update(version=version, directory=directory, encodings=encodings, index=index, detailed=detailed)
+    return _snapshot
+
+def snapshot_headers(snapshot: dict, encoding: str) -> dict:
+    """
+    Returns the headers of a response served from a snapshot.
+    """
+    headers = {'Vary': 'Accept-Encoding', 'ETag': f'"{snapshot["version"]}-{encoding}"'}
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return headers
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Checks if an If-None-Match header holds an ETag, comparing them weakly as required for GET requests.
+    """
+    tags = [tag.strip() for tag in (if_none_match or '').split(',')]
+    return any(tag == '*' or tag.removeprefix('W/') == etag for tag in tags)
+
+def not_modified_response(headers: dict, if_none_match: str):
+    """
+    Returns a 304 response if the client already has the content of a snapshot, None otherwise.
+    """
+    if etag_matches(if_none_match, headers['ETag']):
+        return Response(status_code=304, headers=headers)
+    return None
+
+def summary_snapshot_response(accept_encoding: str, if_none_match: str = None):
+    """
+    Builds the response of the full summary table from the current snapshot.
+
+    Returns:
+        Response: The file of the snapshot in the preferred encoding, or 304 if the client has it
+            already, None if there is no snapshot.
+    """
+    snapshot = current_snapshot()
+    if snapshot is None:
+        return None
+    encoding = negotiate_encoding(accept_encoding, snapshot['encodings'])
+    headers = snapshot_headers(snapshot, encoding)
+    not_modified = not_modified_response(headers, if_none_match)
+    if not_modified is not None:
+        return not_modified
+    path = snapshot['directory'] / f"summary.json{ENCODINGS[encoding]}"
+    return FileResponse(path, media_type="application/json", headers=headers)
+
+def detailed_snapshot_response(summary_id: int, accept_encoding: str, if_none_match: str = None):
+    """
+    Builds the response of the detailed rows of a summary id from the current snapshot.
+
+    Returns:
+        Response: The rows in the preferred encoding, or 304 if the client has them already,
+            None if they are not in the snapshot.
+    """
+    snapshot = current_snapshot()
+    if snapshot is None or summary_id not in snapshot['index']:
+        return None
+    encoding = negotiate_encoding(accept_encoding, snapshot['encodings'])
+    headers = snapshot_headers(snapshot, encoding)
+    not_modified = not_modified_response(headers, if_none_match)
+    if not_modified is not None:
+        return not_modified
+    offset, length = snapshot['index'][summary_id][encoding]
+    content = snapshot['detailed'][encoding][offset:offset + length]
+    return Response(content=content, media_type="application/json", headers=headers)